@@ -4,32 +4,46 @@ Custom PostgreSQL Replication Metrics Exporter
 Provides additional replication-specific metrics for Prometheus
 """
 
+import concurrent.futures
 import os
 import sys
+import threading
 import time
+import types
 import psycopg2
 import psycopg2.extras
-from prometheus_client import start_http_server, Gauge, Counter, Histogram
+from prometheus_client import start_http_server, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Prometheus metrics
-pg_replication_lag_bytes = Gauge('pg_replication_lag_bytes', 'Replication lag in bytes', ['instance'])
-pg_replication_lag_seconds = Gauge('pg_replication_lag_seconds', 'Replication lag in seconds', ['instance'])
-pg_replication_lag_mb = Gauge('pg_replication_lag_mb', 'Replication lag in megabytes', ['instance'])
-pg_replication_connections = Gauge('pg_replication_connections', 'Number of replication connections', ['instance'])
-pg_replication_sync_state = Gauge('pg_replication_sync_state', 'Replication sync state (0=async, 1=sync)', ['instance', 'client_addr'])
-pg_wal_senders = Gauge('pg_wal_senders', 'Number of WAL senders', ['instance'])
-pg_wal_receivers = Gauge('pg_wal_receivers', 'Number of WAL receivers', ['instance'])
-pg_wal_generation_rate = Gauge('pg_wal_generation_rate', 'WAL generation rate in bytes per second', ['instance'])
-pg_replication_slots_total = Gauge('pg_replication_slots_total', 'Total number of replication slots', ['instance'])
-pg_replication_slots_active = Gauge('pg_replication_slots_active', 'Number of active replication slots', ['instance'])
-pg_replication_slots_inactive = Gauge('pg_replication_slots_inactive', 'Number of inactive replication slots', ['instance'])
-pg_replication_health_score = Gauge('pg_replication_health_score', 'Overall replication health score (0-100)', ['instance'])
-pg_data_consistency_check = Gauge('pg_data_consistency_check', 'Data consistency check result (1=consistent, 0=inconsistent)', ['instance'])
+# Metric families are assembled per scrape from a snapshot dict instead of
+# mutating global Gauges: building the samples in one pass takes no
+# per-sample locks, and series for replicas that disappear are dropped
+# naturally because every refresh rebuilds the snapshot from scratch.
+# (snapshot key, metric name, help text) for the instance-labelled families;
+# pg_replication_sync_state and pg_wal_bytes_total are emitted separately
+GAUGE_FAMILIES = (
+    ('lag_bytes', 'pg_replication_lag_bytes', 'Replication lag in bytes'),
+    ('lag_seconds', 'pg_replication_lag_seconds', 'Replication lag in seconds'),
+    ('lag_mb', 'pg_replication_lag_mb', 'Replication lag in megabytes'),
+    ('connections', 'pg_replication_connections', 'Number of replication connections'),
+    ('wal_senders', 'pg_wal_senders', 'Number of WAL senders'),
+    ('wal_receivers', 'pg_wal_receivers', 'Number of WAL receivers'),
+    ('wal_generation_rate', 'pg_wal_generation_rate', 'WAL generation rate in bytes per second'),
+    ('slots_total', 'pg_replication_slots_total', 'Total number of replication slots'),
+    ('slots_active', 'pg_replication_slots_active', 'Number of active replication slots'),
+    ('slots_inactive', 'pg_replication_slots_inactive', 'Number of inactive replication slots'),
+    ('standby_caught_up', 'pg_standby_caught_up', 'Standby has replayed past the primary WAL position from this scrape (1=caught up)'),
+    ('health_score', 'pg_replication_health_score', 'Overall replication health score (0-100)'),
+    ('consistency', 'pg_data_consistency_check', 'Data consistency check result (1=consistent, 0=inconsistent)'),
+)
+
+# Cumulative WAL byte counter, accumulated in process across refreshes
+_wal_bytes_total = {'primary': 0}
 
 # Database connection configuration
 DB_CONFIG = {
@@ -49,340 +63,618 @@ DB_CONFIG = {
     }
 }
 
+# Ready-to-splat psycopg2.connect() kwargs, compiled once at import: the env
+# vars never change after startup, so the port coercion, the database→dbname
+# rename and the keepalive settings don't need rebuilding on every reconnect.
+# Frozen with MappingProxyType so nothing can mutate them accidentally
+DB_KWARGS = types.MappingProxyType({
+    instance: types.MappingProxyType({
+        'host': config['host'],
+        'port': int(config['port']),
+        'dbname': config['database'],
+        'user': config['user'],
+        'password': config['password'],
+        'keepalives': 1,
+        'keepalives_idle': 30,
+        'keepalives_interval': 10,
+        'keepalives_count': 3,
+    })
+    for instance, config in DB_CONFIG.items()
+})
+
+# Adaptive refresh interval bounds in seconds: while the cluster is quiet,
+# scrapes are served from the cached metrics for longer; as soon as activity
+# is seen the refresh interval snaps back to the minimum. The minimum also
+# coalesces near-simultaneous scrapes from HA Prometheus pairs
+MIN_INTERVAL = float(os.getenv('MIN_SCRAPE_INTERVAL', '5'))
+MAX_INTERVAL = float(os.getenv('MAX_SCRAPE_INTERVAL', '60'))
+
+# How long a scrape waits for a refresh already in flight before serving
+# whatever the Gauges currently hold
+SCRAPE_TIMEOUT = float(os.getenv('SCRAPE_TIMEOUT', '10'))
+
+# Last observed primary activity markers, used to adapt the polling interval
+_activity = {'lag_bytes': None, 'wal_bytes': None}
+
+# Previous WAL position and timestamp, for deriving the generation rate
+_last_wal = {'bytes': None, 'ts': None}
+
+# Cached connections, one per instance, reused across scrape cycles
+_conns = {'primary': None, 'standby': None}
+
+# One long-lived cursor per cached connection; creating a cursor per query
+# only adds allocations on the scrape path
+_cursors = {'primary': None, 'standby': None}
+
+# Names of statements already PREPAREd on the cached connection, per instance
+_prepared = {'primary': set(), 'standby': set()}
+
+# Shared worker pool: primary and standby collection run in parallel. The
+# exporter stays on synchronous psycopg2 + threads rather than asyncio and
+# asyncpg: with one bundled query per instance there are only ever two
+# in-flight operations, so an event loop would add a dependency and a second
+# concurrency model without removing any round-trips
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='collect')
+
+def _connect(instance):
+    """Open a new connection for specified instance"""
+    conn = psycopg2.connect(**DB_KWARGS[instance])
+    conn.autocommit = True
+    # Fresh backend: nothing is prepared on it yet
+    _prepared[instance].clear()
+    _cursors[instance] = conn.cursor()
+    return conn
+
+def execute_prepared(instance, cursor, name, sql):
+    """Execute a fixed scrape query as a server-side prepared statement
+
+    The statement is PREPAREd once per connection so Postgres skips the
+    parse/plan step on every later scrape.
+    """
+    if name not in _prepared[instance]:
+        cursor.execute(f"PREPARE {name} AS {sql.rstrip().rstrip(';')};")
+        _prepared[instance].add(name)
+    cursor.execute(f"EXECUTE {name};")
+
+def streaming_cursor(conn, name):
+    """Get a named (server-side) cursor that streams rows in chunks
+
+    Regular cursors buffer the whole result client-side. Any query
+    expected to return more than a handful of rows (per-slot or
+    per-table metrics, for example) should go through this instead so
+    the server streams rows and the exporter's memory stays flat. The
+    cursor is declared WITH HOLD because the cached connections run in
+    autocommit mode; the caller must close it to free the server-side
+    portal.
+    """
+    cursor = conn.cursor(name=name, withhold=True)
+    cursor.itersize = 500
+    return cursor
+
 def get_db_connection(instance):
-    """Get database connection for specified instance"""
-    config = DB_CONFIG[instance]
+    """Get cached database connection for specified instance, reconnecting if needed"""
     try:
-        conn = psycopg2.connect(
-            host=config['host'],
-            port=config['port'],
-            database=config['database'],
-            user=config['user'],
-            password=config['password']
-        )
+        conn = _conns[instance]
+        if conn is None or conn.closed != 0:
+            conn = _connect(instance)
+            _conns[instance] = conn
+
+        # Health-check the cached connection; reconnect once on failure
+        try:
+            _cursors[instance].execute("SELECT 1;")
+        except psycopg2.OperationalError:
+            logger.warning(f"Cached connection to {instance} is stale, reconnecting")
+            conn.close()
+            conn = _connect(instance)
+            _conns[instance] = conn
+
         return conn
     except psycopg2.Error as e:
         logger.error(f"Failed to connect to {instance}: {e}")
+        _conns[instance] = None
         return None
 
-def get_replication_lag_metrics(instance, conn):
-    """Get replication lag metrics"""
-    try:
-        cursor = conn.cursor()
-        
-        if instance == 'primary':
-            # Get lag from primary perspective
-            cursor.execute("""
-                SELECT 
-                    COALESCE(
-                        pg_wal_lsn_diff(
-                            pg_current_wal_lsn(),
-                            MIN(replay_lsn)
-                        ), 0
-                    ) as lag_bytes,
-                    COALESCE(
-                        EXTRACT(EPOCH FROM (
-                            now() - MIN(pg_last_xact_replay_timestamp())
-                        )), 0
-                    ) as lag_seconds
-                FROM pg_stat_replication;
-            """)
-        else:
-            # Get lag from standby perspective
-            cursor.execute("""
-                SELECT 
-                    COALESCE(
-                        pg_wal_lsn_diff(
-                            pg_last_wal_receive_lsn(),
-                            pg_last_wal_replay_lsn()
-                        ), 0
-                    ) as lag_bytes,
-                    COALESCE(
-                        EXTRACT(EPOCH FROM (
-                            now() - pg_last_xact_replay_timestamp()
-                        )), 0
-                    ) as lag_seconds;
-            """)
-        
-        result = cursor.fetchone()
-        if result:
-            lag_bytes, lag_seconds = result
-            lag_mb = lag_bytes / (1024 * 1024)
-            
-            pg_replication_lag_bytes.labels(instance=instance).set(lag_bytes)
-            pg_replication_lag_seconds.labels(instance=instance).set(lag_seconds)
-            pg_replication_lag_mb.labels(instance=instance).set(lag_mb)
-            
-            logger.debug(f"{instance} replication lag: {lag_bytes} bytes, {lag_seconds} seconds")
-        
-        cursor.close()
-        
-    except psycopg2.Error as e:
-        logger.error(f"Failed to get replication lag metrics for {instance}: {e}")
+# All primary-side metrics in a single round-trip
+PRIMARY_BUNDLE_SQL = """
+    WITH repl AS (
+        SELECT
+            client_addr,
+            sync_state,
+            replay_lsn,
+            pg_last_xact_replay_timestamp() as replay_ts
+        FROM pg_stat_replication
+    ),
+    slots AS (
+        SELECT
+            COUNT(*) as total_slots,
+            COUNT(*) FILTER (WHERE active = true) as active_slots,
+            COUNT(*) FILTER (WHERE active = false) as inactive_slots
+        FROM pg_replication_slots
+    )
+    SELECT
+        COALESCE(
+            pg_wal_lsn_diff(
+                pg_current_wal_lsn(),
+                (SELECT MIN(replay_lsn) FROM repl)
+            ), 0
+        )::int8 as lag_bytes,
+        COALESCE(
+            EXTRACT(EPOCH FROM (
+                now() - (SELECT MIN(replay_ts) FROM repl)
+            )), 0
+        )::float8 as lag_seconds,
+        (SELECT json_agg(json_build_array(
+            host(client_addr),
+            CASE WHEN sync_state = 'sync' THEN 1 ELSE 0 END
+        )) FROM repl) as sync_states,
+        pg_current_wal_lsn()::text as current_lsn,
+        pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')::int8 as total_wal_bytes,
+        (SELECT total_slots FROM slots) as total_slots,
+        (SELECT active_slots FROM slots) as active_slots,
+        (SELECT inactive_slots FROM slots) as inactive_slots;
+"""
 
-def get_replication_connection_metrics(instance, conn):
-    """Get replication connection metrics"""
-    try:
-        cursor = conn.cursor()
-        
-        if instance == 'primary':
-            # Count replication connections from primary
-            cursor.execute("""
-                SELECT 
-                    COUNT(*) as connection_count,
-                    COUNT(*) FILTER (WHERE sync_state = 'sync') as sync_count
-                FROM pg_stat_replication;
-            """)
-            
-            result = cursor.fetchone()
-            if result:
-                total_connections, sync_connections = result
-                pg_replication_connections.labels(instance=instance).set(total_connections)
-                
-                # Set sync state (1 if any sync connections, 0 otherwise)
-                sync_state = 1 if sync_connections > 0 else 0
-                pg_replication_sync_state.labels(instance=instance, client_addr='all').set(sync_state)
-            
-            # Get individual sync states
-            cursor.execute("""
-                SELECT 
-                    client_addr,
-                    CASE WHEN sync_state = 'sync' THEN 1 ELSE 0 END as sync_state
-                FROM pg_stat_replication;
-            """)
-            
-            for row in cursor.fetchall():
-                client_addr, sync_state = row
-                pg_replication_sync_state.labels(instance=instance, client_addr=str(client_addr)).set(sync_state)
-        
-        cursor.close()
-        
-    except psycopg2.Error as e:
-        logger.error(f"Failed to get replication connection metrics for {instance}: {e}")
+# All standby-side metrics in a single round-trip
+STANDBY_BUNDLE_SQL = """
+    SELECT
+        COALESCE(
+            pg_wal_lsn_diff(
+                pg_last_wal_receive_lsn(),
+                pg_last_wal_replay_lsn()
+            ), 0
+        )::int8 as lag_bytes,
+        COALESCE(
+            EXTRACT(EPOCH FROM (
+                now() - pg_last_xact_replay_timestamp()
+            )), 0
+        )::float8 as lag_seconds,
+        (SELECT COUNT(*) FROM pg_stat_wal_receiver) as wal_receivers,
+        pg_is_in_recovery() as in_recovery,
+        pg_last_wal_replay_lsn()::text as replay_lsn;
+"""
+
+# Table compared by the opt-in deep consistency check
+CONSISTENCY_TABLE = os.getenv('CONSISTENCY_TABLE', 'test_data')
+
+# Dynamic SQL composed once at first use; the scrape path only ever
+# executes prebuilt strings
+_sql_cache = {'consistency_count': None}
+
+def _consistency_count_sql(conn):
+    """Get the deep-check COUNT statement, composed once per process
+
+    The configurable table name is quoted through the connection-level
+    adapter (quote_ident takes the connection, not a cursor, which also
+    side-steps any APM cursor proxies) and the composed string is cached.
+    """
+    if _sql_cache['consistency_count'] is None:
+        table = psycopg2.extensions.quote_ident(CONSISTENCY_TABLE, conn)
+        _sql_cache['consistency_count'] = f"SELECT COUNT(*) FROM {table};"
+    return _sql_cache['consistency_count']
+
+# Consistency is declared when the standby has replayed to within this many
+# bytes of the primary's current WAL position
+CONSISTENCY_LAG_THRESHOLD = int(os.getenv('CONSISTENCY_LAG_THRESHOLD_BYTES', str(1024 * 1024)))
 
-def get_wal_metrics(instance, conn):
-    """Get WAL-related metrics"""
+# Opt-in deep consistency check: also compares test_data row counts, which
+# sequential-scans the table on both instances, so it runs at most hourly
+DEEP_CONSISTENCY_CHECK = os.getenv('DEEP_CONSISTENCY_CHECK', '0') == '1'
+DEEP_CONSISTENCY_INTERVAL = 3600
+_last_deep_check = {'ts': 0.0}
+
+# WAL positions captured by this scrape's bundles, consumed by the
+# consistency check without any extra round-trips
+_lsn_snapshot = {'primary': None, 'standby': None}
+
+def collect_primary_bundle():
+    """Collect all primary-side metrics from one bundled query
+
+    Returns the snapshot sections for the primary, or None if the query
+    failed.
+    """
     try:
-        cursor = conn.cursor()
-        
-        if instance == 'primary':
-            # WAL senders count
-            cursor.execute("SELECT COUNT(*) FROM pg_stat_replication;")
-            wal_senders = cursor.fetchone()[0]
-            pg_wal_senders.labels(instance=instance).set(wal_senders)
-            
-            # WAL generation rate (simplified)
-            cursor.execute("""
-                SELECT 
-                    pg_wal_lsn_diff(
-                        pg_current_wal_lsn(),
-                        '0/0'
-                    ) as total_wal_bytes;
-            """)
-            total_wal_bytes = cursor.fetchone()[0]
-            pg_wal_generation_rate.labels(instance=instance).set(total_wal_bytes)
-            
-        else:
-            # WAL receivers count
-            cursor.execute("SELECT COUNT(*) FROM pg_stat_wal_receiver;")
-            wal_receivers = cursor.fetchone()[0]
-            pg_wal_receivers.labels(instance=instance).set(wal_receivers)
-        
-        cursor.close()
-        
+        cursor = _cursors['primary']
+        execute_prepared('primary', cursor, 'primary_bundle', PRIMARY_BUNDLE_SQL)
+        (lag_bytes, lag_seconds, sync_states, current_lsn,
+         total_wal_bytes, total_slots, active_slots, inactive_slots) = cursor.fetchone()
+
+        _lsn_snapshot['primary'] = current_lsn
+        logger.debug(f"primary replication lag: {lag_bytes} bytes, {lag_seconds} seconds")
+
+        # Connection totals are derived from the per-replica rows rather than
+        # re-aggregated server-side; 'all' is 1 if any connection is sync.
+        # host(client_addr) in the bundle SQL already yields plain strings;
+        # str() only covers the NULL address of local replication connections
+        sync_states = sync_states or []
+        connection_count = len(sync_states)
+        sync_section = {('primary', 'all'): 1 if any(flag for _, flag in sync_states) else 0}
+        for client_addr, sync_state in sync_states:
+            sync_section[('primary', str(client_addr))] = sync_state
+
+        # Derive the WAL generation rate from the delta against the previous
+        # refresh; the raw byte counter lets dashboards apply rate() as well
+        now = time.monotonic()
+        wal_rate = 0.0
+        if _last_wal['bytes'] is not None:
+            delta_bytes = total_wal_bytes - _last_wal['bytes']
+            elapsed = now - _last_wal['ts']
+            if delta_bytes >= 0 and elapsed > 0:
+                _wal_bytes_total['primary'] += delta_bytes
+                wal_rate = delta_bytes / elapsed
+            # On a backwards LSN (failover or restart) just reset the baseline
+        _last_wal['bytes'] = total_wal_bytes
+        _last_wal['ts'] = now
+
+        # Activity markers for the adaptive refresh interval
+        _activity['lag_bytes'] = lag_bytes
+        _activity['wal_bytes'] = total_wal_bytes
+
+        health = calculate_health_score('primary', lag_bytes, lag_seconds,
+                                        replication_count=connection_count)
+
+        return {
+            'lag_bytes': {'primary': lag_bytes},
+            'lag_seconds': {'primary': lag_seconds},
+            'lag_mb': {'primary': lag_bytes / (1024 * 1024)},
+            'connections': {'primary': connection_count},
+            'sync_state': sync_section,
+            # Every replication connection has one WAL sender
+            'wal_senders': {'primary': connection_count},
+            'wal_generation_rate': {'primary': wal_rate},
+            'wal_bytes_total': {'primary': _wal_bytes_total['primary']},
+            'slots_total': {'primary': total_slots},
+            'slots_active': {'primary': active_slots},
+            'slots_inactive': {'primary': inactive_slots},
+            'health_score': {'primary': health},
+        }
+
+    except psycopg2.OperationalError:
+        # Let collect_metrics invalidate the cached connection
+        raise
     except psycopg2.Error as e:
-        logger.error(f"Failed to get WAL metrics for {instance}: {e}")
+        logger.error(f"Failed to collect primary metrics bundle: {e}")
+        return None
 
-def get_replication_slot_metrics(instance, conn):
-    """Get replication slot metrics"""
+def collect_standby_bundle():
+    """Collect all standby-side metrics from one bundled query
+
+    Returns the snapshot sections for the standby, or None if the query
+    failed.
+    """
     try:
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total_slots,
-                COUNT(*) FILTER (WHERE active = true) as active_slots,
-                COUNT(*) FILTER (WHERE active = false) as inactive_slots
-            FROM pg_replication_slots;
-        """)
-        
-        result = cursor.fetchone()
-        if result:
-            total_slots, active_slots, inactive_slots = result
-            pg_replication_slots_total.labels(instance=instance).set(total_slots)
-            pg_replication_slots_active.labels(instance=instance).set(active_slots)
-            pg_replication_slots_inactive.labels(instance=instance).set(inactive_slots)
-        
-        cursor.close()
-        
+        cursor = _cursors['standby']
+        execute_prepared('standby', cursor, 'standby_bundle', STANDBY_BUNDLE_SQL)
+        lag_bytes, lag_seconds, wal_receivers, in_recovery, replay_lsn = cursor.fetchone()
+
+        _lsn_snapshot['standby'] = replay_lsn
+        logger.debug(f"standby replication lag: {lag_bytes} bytes, {lag_seconds} seconds")
+
+        health = calculate_health_score('standby', lag_bytes, lag_seconds,
+                                        in_recovery=in_recovery)
+
+        return {
+            'lag_bytes': {'standby': lag_bytes},
+            'lag_seconds': {'standby': lag_seconds},
+            'lag_mb': {'standby': lag_bytes / (1024 * 1024)},
+            'wal_receivers': {'standby': wal_receivers},
+            'health_score': {'standby': health},
+        }
+
+    except psycopg2.OperationalError:
+        # Let collect_metrics invalidate the cached connection
+        raise
     except psycopg2.Error as e:
-        logger.error(f"Failed to get replication slot metrics for {instance}: {e}")
+        logger.error(f"Failed to collect standby metrics bundle: {e}")
+        return None
+
+# How long WAIT FOR LSN blocks on the standby before reporting a timeout
+WAIT_FOR_LSN_TIMEOUT_MS = 100
+
+# Whether the standby server understands WAIT FOR LSN, probed once per
+# process: None = not yet probed, then True/False
+_wait_for_lsn = {'supported': None}
+
+def check_standby_caught_up():
+    """Check whether the standby has replayed up to the primary's position
+
+    Prefers WAIT FOR LSN ... MODE REPLAY, which parks on the backend's
+    latch and wakes as soon as replay passes the target instead of
+    re-polling pg_last_wal_replay_lsn(). Servers that predate the syntax
+    are detected once and remembered; for those the check falls back to
+    comparing the LSNs the bundles already captured. Returns 1/0, or
+    None when either position is unknown this scrape.
+    """
+    primary_lsn = _lsn_snapshot['primary']
+    standby_lsn = _lsn_snapshot['standby']
+
+    if primary_lsn is None or standby_lsn is None:
+        return None
+
+    if _wait_for_lsn['supported'] is not False:
+        # Safe to reuse the standby cursor here: the bundle futures have
+        # already completed by the time collect_metrics runs this. The
+        # LSN literal is server-reported, not user input
+        cursor = _cursors['standby']
+        try:
+            cursor.execute(
+                f"WAIT FOR LSN '{primary_lsn}' MODE REPLAY TIMEOUT {WAIT_FOR_LSN_TIMEOUT_MS};"
+            )
+            _wait_for_lsn['supported'] = True
+            if cursor.description:
+                # Some server versions report 'success'/'timeout' as a row
+                # instead of raising on timeout
+                status = cursor.fetchone()[0]
+                return 1 if status == 'success' else 0
+            return 1
+        except psycopg2.errors.SyntaxError:
+            _wait_for_lsn['supported'] = False
+            logger.info("Standby does not support WAIT FOR LSN; "
+                        "falling back to LSN comparison")
+        except psycopg2.Error as e:
+            # Timed out waiting for replay: not caught up
+            logger.debug(f"WAIT FOR LSN did not reach {primary_lsn}: {e}")
+            return 0
+
+    return 1 if _lsn_to_int(standby_lsn) >= _lsn_to_int(primary_lsn) else 0
+
+def _lsn_to_int(lsn):
+    """Convert a pg_lsn string like '0/16B3740' to an absolute byte position"""
+    hi, lo = lsn.split('/')
+    return (int(hi, 16) << 32) + int(lo, 16)
 
 def get_data_consistency_metrics():
-    """Get data consistency metrics by comparing record counts"""
+    """Get data consistency metrics by comparing WAL positions
+
+    The standby is considered consistent when the replay position it
+    reported this scrape is within CONSISTENCY_LAG_THRESHOLD bytes of
+    the primary's current WAL position. Both positions were already
+    captured by the instance bundles, so no extra round-trips are
+    issued; only the opt-in deep check touches the database. Returns the
+    consistency flag, or None when the primary position is unknown.
+    """
+    primary_lsn = _lsn_snapshot['primary']
+    standby_lsn = _lsn_snapshot['standby']
+
+    if primary_lsn is None:
+        # Primary bundle failed this scrape; nothing to compare against
+        return None
+
+    if standby_lsn is None:
+        # Standby is unreachable or not replaying (promoted or misconfigured)
+        consistency = 0
+    else:
+        diff_bytes = _lsn_to_int(primary_lsn) - _lsn_to_int(standby_lsn)
+        consistency = 1 if diff_bytes < CONSISTENCY_LAG_THRESHOLD else 0
+        logger.debug(f"Data consistency check: Primary={primary_lsn}, Standby={standby_lsn}, "
+                     f"Diff={diff_bytes} bytes, Consistent={consistency}")
+
+    # Diagnostic row-count comparison, opt-in and rate-limited
+    if DEEP_CONSISTENCY_CHECK and time.monotonic() - _last_deep_check['ts'] >= DEEP_CONSISTENCY_INTERVAL:
+        try:
+            primary_conn = get_db_connection('primary')
+            standby_conn = get_db_connection('standby')
+
+            if primary_conn and standby_conn:
+                _last_deep_check['ts'] = time.monotonic()
+
+                primary_cursor = _cursors['primary']
+                standby_cursor = _cursors['standby']
+
+                count_sql = _consistency_count_sql(primary_conn)
+                execute_prepared('primary', primary_cursor, 'consistency_count', count_sql)
+                primary_count = primary_cursor.fetchone()[0]
+
+                execute_prepared('standby', standby_cursor, 'consistency_count', count_sql)
+                standby_count = standby_cursor.fetchone()[0]
+
+                if primary_count != standby_count:
+                    consistency = 0
+                logger.info(f"Deep consistency check: Primary={primary_count}, Standby={standby_count}")
+
+        except psycopg2.OperationalError as e:
+            logger.error(f"Failed to run deep consistency check: {e}")
+            _conns['primary'] = None
+            _conns['standby'] = None
+        except psycopg2.Error as e:
+            logger.error(f"Failed to run deep consistency check: {e}")
+
+    return consistency
+
+# (threshold, penalty) pairs, scanned in order; the first match applies
+LAG_BYTES_PENALTIES = ((10485760, 30), (1048576, 10))  # > 10MB, > 1MB
+LAG_SECONDS_PENALTIES = ((30, 20), (5, 5))  # > 30s, > 5s
+
+def _lag_penalty(value, penalties):
+    """Get the health score penalty for a lag value"""
+    for threshold, penalty in penalties:
+        if value > threshold:
+            return penalty
+    return 0
+
+def calculate_health_score(instance, lag_bytes, lag_seconds, replication_count=0, in_recovery=True):
+    """Calculate overall replication health score from already-fetched values
+
+    Pure arithmetic over the bundle results — no extra queries. Returns
+    the 0-100 score.
+    """
+    health_score = 100
+
+    if instance == 'primary':
+        if replication_count == 0:
+            health_score -= 50  # No replication connections
+        health_score -= _lag_penalty(lag_bytes, LAG_BYTES_PENALTIES)
+    else:
+        if not in_recovery:
+            health_score -= 30  # Standby should be in recovery
+        health_score -= _lag_penalty(lag_bytes, LAG_BYTES_PENALTIES)
+        health_score -= _lag_penalty(lag_seconds, LAG_SECONDS_PENALTIES)
+
+    # Ensure health score is between 0 and 100
+    health_score = max(0, min(100, health_score))
+
+    logger.debug(f"{instance} health score: {health_score}")
+
+    return health_score
+
+def _collect_primary():
+    """Collect all primary-side metric sections"""
+    conn = get_db_connection('primary')
+    if not conn:
+        return None
     try:
-        primary_conn = get_db_connection('primary')
-        standby_conn = get_db_connection('standby')
-        
-        if not primary_conn or not standby_conn:
-            return
-        
-        primary_cursor = primary_conn.cursor()
-        standby_cursor = standby_conn.cursor()
-        
-        # Get record counts from both instances
-        primary_cursor.execute("SELECT COUNT(*) FROM test_data;")
-        primary_count = primary_cursor.fetchone()[0]
-        
-        standby_cursor.execute("SELECT COUNT(*) FROM test_data;")
-        standby_count = standby_cursor.fetchone()[0]
-        
-        # Set consistency metric (1 if consistent, 0 if not)
-        consistency = 1 if primary_count == standby_count else 0
-        pg_data_consistency_check.labels(instance='cluster').set(consistency)
-        
-        logger.debug(f"Data consistency check: Primary={primary_count}, Standby={standby_count}, Consistent={consistency}")
-        
-        primary_cursor.close()
-        standby_cursor.close()
-        primary_conn.close()
-        standby_conn.close()
-        
-    except psycopg2.Error as e:
-        logger.error(f"Failed to get data consistency metrics: {e}")
+        return collect_primary_bundle()
+    except psycopg2.OperationalError as e:
+        logger.error(f"Lost connection to primary during collection: {e}")
+        _conns['primary'] = None
+        return None
 
-def calculate_health_score(instance, conn):
-    """Calculate overall replication health score"""
+def _collect_standby():
+    """Collect all standby-side metric sections"""
+    conn = get_db_connection('standby')
+    if not conn:
+        return None
     try:
-        cursor = conn.cursor()
-        health_score = 100
-        
-        if instance == 'primary':
-            # Check replication connections
-            cursor.execute("SELECT COUNT(*) FROM pg_stat_replication;")
-            replication_count = cursor.fetchone()[0]
-            
-            if replication_count == 0:
-                health_score -= 50  # No replication connections
-            elif replication_count < 1:
-                health_score -= 20  # Less than expected connections
-            
-            # Check replication lag
-            cursor.execute("""
-                SELECT 
-                    COALESCE(
-                        pg_wal_lsn_diff(
-                            pg_current_wal_lsn(),
-                            MIN(replay_lsn)
-                        ), 0
-                    ) as lag_bytes
-                FROM pg_stat_replication;
-            """)
-            
-            result = cursor.fetchone()
-            if result:
-                lag_bytes = result[0]
-                if lag_bytes > 10485760:  # > 10MB
-                    health_score -= 30
-                elif lag_bytes > 1048576:  # > 1MB
-                    health_score -= 10
-        
-        else:
-            # Check if in recovery mode
-            cursor.execute("SELECT pg_is_in_recovery();")
-            in_recovery = cursor.fetchone()[0]
-            
-            if not in_recovery:
-                health_score -= 30  # Standby should be in recovery
-            
-            # Check replication lag
-            cursor.execute("""
-                SELECT 
-                    COALESCE(
-                        pg_wal_lsn_diff(
-                            pg_last_wal_receive_lsn(),
-                            pg_last_wal_replay_lsn()
-                        ), 0
-                    ) as lag_bytes,
-                    COALESCE(
-                        EXTRACT(EPOCH FROM (
-                            now() - pg_last_xact_replay_timestamp()
-                        )), 0
-                    ) as lag_seconds
-                FROM pg_stat_wal_receiver;
-            """)
-            
-            result = cursor.fetchone()
-            if result:
-                lag_bytes, lag_seconds = result
-                if lag_bytes > 10485760:  # > 10MB
-                    health_score -= 30
-                elif lag_bytes > 1048576:  # > 1MB
-                    health_score -= 10
-                
-                if lag_seconds > 30:  # > 30 seconds
-                    health_score -= 20
-                elif lag_seconds > 5:  # > 5 seconds
-                    health_score -= 5
-        
-        # Ensure health score is between 0 and 100
-        health_score = max(0, min(100, health_score))
-        pg_replication_health_score.labels(instance=instance).set(health_score)
-        
-        logger.debug(f"{instance} health score: {health_score}")
-        
-        cursor.close()
-        
-    except psycopg2.Error as e:
-        logger.error(f"Failed to calculate health score for {instance}: {e}")
+        return collect_standby_bundle()
+    except psycopg2.OperationalError as e:
+        logger.error(f"Lost connection to standby during collection: {e}")
+        _conns['standby'] = None
+        return None
 
 def collect_metrics():
-    """Collect all metrics from both primary and standby"""
+    """Collect all metrics from both instances into a fresh snapshot dict"""
     logger.info("Collecting replication metrics...")
-    
-    # Collect metrics from primary
-    primary_conn = get_db_connection('primary')
-    if primary_conn:
-        get_replication_lag_metrics('primary', primary_conn)
-        get_replication_connection_metrics('primary', primary_conn)
-        get_wal_metrics('primary', primary_conn)
-        get_replication_slot_metrics('primary', primary_conn)
-        calculate_health_score('primary', primary_conn)
-        primary_conn.close()
-    
-    # Collect metrics from standby
-    standby_conn = get_db_connection('standby')
-    if standby_conn:
-        get_replication_lag_metrics('standby', standby_conn)
-        get_wal_metrics('standby', standby_conn)
-        calculate_health_score('standby', standby_conn)
-        standby_conn.close()
-    
-    # Collect cluster-wide metrics
-    get_data_consistency_metrics()
-    
+
+    # The two instances are independent servers, so collect from them
+    # concurrently (libpq releases the GIL during I/O)
+    _lsn_snapshot['primary'] = None
+    _lsn_snapshot['standby'] = None
+    futures = [
+        _executor.submit(_collect_primary),
+        _executor.submit(_collect_standby),
+    ]
+    concurrent.futures.wait(futures)
+
+    snapshot = {}
+    for future in futures:
+        exc = future.exception()
+        if exc:
+            logger.error(f"Error in metrics collection task: {exc}")
+            continue
+        sections = future.result()
+        if sections:
+            for name, samples in sections.items():
+                snapshot.setdefault(name, {}).update(samples)
+
+    # Consistency is derived from the WAL positions the bundles captured
+    consistency = get_data_consistency_metrics()
+    if consistency is not None:
+        snapshot['consistency'] = {'cluster': consistency}
+
+    caught_up = check_standby_caught_up()
+    if caught_up is not None:
+        snapshot['standby_caught_up'] = {'standby': caught_up}
+
     logger.info("Metrics collection completed")
 
+    return snapshot
+
+class ReplicationCollector:
+    """Collect replication metrics on demand when Prometheus scrapes
+
+    collect() re-runs the DB collection if the cached snapshot is older
+    than the current adaptive refresh interval, then hand-assembles the
+    metric families from the snapshot in one pass — no mutable global
+    Gauges and no per-sample locks. A side that failed its refresh simply
+    contributes no samples, so its series go stale in Prometheus rather
+    than freezing at the last good value.
+
+    Refreshes are single-flight: when HA Prometheus pairs scrape at the
+    same moment, one scrape runs the collection while the others wait
+    for it to finish and share its result, so the databases see at most
+    one refresh per scrape burst.
+    """
+
+    def __init__(self):
+        self._snapshot = {}
+        self._last_refresh = 0.0
+        self._interval = MIN_INTERVAL
+        self._refreshing = threading.Lock()
+        self._refresh_done = threading.Event()
+        self._refresh_done.set()
+
+    def describe(self):
+        # Registration must not trigger a DB collection; an empty
+        # description just skips the registry's duplicate check
+        return []
+
+    def _refresh(self):
+        try:
+            previous_activity = dict(_activity)
+            self._snapshot = collect_metrics()
+            self._last_refresh = time.monotonic()
+
+            if _activity == previous_activity:
+                self._interval = min(self._interval * 1.5, MAX_INTERVAL)
+                logger.debug(f"No replication activity, backing off to {self._interval:.1f}s")
+            else:
+                self._interval = MIN_INTERVAL
+        except Exception as e:
+            logger.error(f"Error in metrics collection: {e}")
+
+    def collect(self):
+        now = time.monotonic()
+        if now - self._last_refresh >= self._interval:
+            if self._refreshing.acquire(blocking=False):
+                # This scrape leads the refresh
+                self._refresh_done.clear()
+                try:
+                    self._refresh()
+                finally:
+                    self._refresh_done.set()
+                    self._refreshing.release()
+            else:
+                # Another scrape is already refreshing: wait for its result
+                # instead of hitting the databases again
+                self._refresh_done.wait(timeout=SCRAPE_TIMEOUT)
+
+        snapshot = self._snapshot
+
+        for key, name, documentation in GAUGE_FAMILIES:
+            family = GaugeMetricFamily(name, documentation, labels=['instance'])
+            for instance, value in snapshot.get(key, {}).items():
+                family.add_metric([instance], value)
+            yield family
+
+        sync_family = GaugeMetricFamily('pg_replication_sync_state',
+                                        'Replication sync state (0=async, 1=sync)',
+                                        labels=['instance', 'client_addr'])
+        for (instance, client_addr), value in snapshot.get('sync_state', {}).items():
+            sync_family.add_metric([instance, client_addr], value)
+        yield sync_family
+
+        wal_family = CounterMetricFamily('pg_wal_bytes', 'WAL bytes generated',
+                                         labels=['instance'])
+        for instance, value in snapshot.get('wal_bytes_total', {}).items():
+            wal_family.add_metric([instance], value)
+        yield wal_family
+
 def main():
     """Main function"""
     port = int(os.getenv('EXPORTER_PORT', '9188'))
-    
+
     logger.info(f"Starting PostgreSQL Replication Metrics Exporter on port {port}")
-    
+
+    # Metrics are collected on demand, driven by Prometheus scrapes
+    REGISTRY.register(ReplicationCollector())
+
     # Start Prometheus metrics server
     start_http_server(port)
-    
-    # Collect metrics every 15 seconds
-    while True:
-        try:
-            collect_metrics()
-            time.sleep(15)
-        except KeyboardInterrupt:
-            logger.info("Exporter stopped by user")
-            break
-        except Exception as e:
-            logger.error(f"Error in metrics collection: {e}")
-            time.sleep(15)
+
+    # All work happens on the HTTP server's scrape threads
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        logger.info("Exporter stopped by user")
 
 if __name__ == '__main__':
     main()